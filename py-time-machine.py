@@ -6,26 +6,37 @@ Rsync Time Machine Style backup.
 Inspired by rsync-time-machine https://github.com/infinet/rsync-time-machine
 """
 import argparse
+import bisect
+import concurrent.futures
 import datetime
 import fcntl
-import getpass
-import hashlib
+import functools
 import logging
 import os
 import re
+import shlex
 import shutil
 import subprocess
 import sys
 
-import yaml
-import yaml.error
-
 ONEK = 1024.0
 ONEM = 1048576.0
 ONEG = 1073741824.0
 ONET = 1099511627776.0
 ONEDAY = datetime.timedelta(days=1)
 
+# (divisor, suffix, format) indexed by bit length of the value
+BYTE_UNITS = ((1, 'Bytes', '%d'),
+              (1 << 10, 'KB', '%.0f'),
+              (1 << 20, 'MB', '%.0f'),
+              (1 << 30, 'GB', '%.2f'),
+              (1 << 40, 'TB', '%.2f'))
+INODE_UNITS = ((1, '', '%d'),
+               (1 << 10, 'K', '%.0f'),
+               (1 << 20, 'M', '%.0f'),
+               (1 << 30, 'G', '%.0f'),
+               (1 << 40, 'T', '%.0f'))
+
 XDG_CONF_DIR = os.getenv('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
 CONF_FILES = [os.path.join(XDG_CONF_DIR, 'py-time-machine.yaml'),
               '/etc/py-time-machine.yaml']
@@ -34,6 +45,8 @@ if os.getuid() == 0:
     LOG_FILE = '/var/log/py-time-machine.log'
 else:
     LOG_FILE = '/tmp/py-time-machine.log'
+SNAPSHOT_PAT = re.compile(r'^(\d{4})-(\d{2})-(\d{2})'
+                          r'_(\d{2}):(\d{2}):(\d{2})_GMT$')
 REMOTE_PAT = re.compile(r'^((?P<user>[A-Za-z0-9\._%\+\-]+)@)?'
                         r'((?P<host>[A-Za-z0-9.\-]+)\:)'
                         r'(?P<path>.+$)')
@@ -48,12 +61,10 @@ RSYNC_ARGS = ('--delete',
               '--one-file-system',
               '--owner',
               '--perms',
-              '--progress',
               '--recursive',
               '--relative',
               '--times',
-              '-D',
-              '-q')
+              '-D')
 
 RSYNC_EXIT_CODE = {0: 'Success',
                    1: 'Syntax or usage error',
@@ -79,14 +90,11 @@ RSYNC_EXIT_CODE = {0: 'Success',
                    30: 'Timeout in data send/receive',
                    35: 'Timeout waiting for daemon connection'}
 
-PAT_STAT = re.compile(r'.*Namelen: (?P<namemax>\d+).*'
-                      r'Block size: (?P<bsize>\d+)\s+'
-                      r'Fundamental block size: (?P<frsize>\d+).*'
-                      r'Blocks: Total: (?P<blocks>\d+)\s+'
-                      r'Free: (?P<bfree>\d+)\s+'
-                      r'Available: (?P<bavail>\d+).*'
-                      r'Inodes: Total: (?P<files>\d+)\s+'
-                      r'Free: (?P<ffree>\d+)', re.DOTALL | re.MULTILINE)
+# field order matches STAT_FORMAT below; colon-separated so the format
+# survives the remote shell's word splitting after ssh joins the argv
+STAT_FIELDS = ('namemax', 'bsize', 'frsize', 'blocks', 'bfree', 'bavail',
+               'files', 'ffree')
+STAT_FORMAT = '--format=%l:%s:%S:%b:%f:%a:%c:%d'
 
 
 class PyTimeMachine:
@@ -107,7 +115,6 @@ class PyTimeMachine:
         if args.config:
             self._configfile = args.config
         self._is_src_remote = None
-        self._is_dst_remote = None
         self._fl = None
 
         self._check_inodes = True
@@ -129,9 +136,10 @@ class PyTimeMachine:
         self._flock_exclusive()
         try:
             logging.info("Start backup to %s", self.destination)
+            now = datetime.datetime.utcnow()
             self._create_dest_directory()
             stat_before = self._check_freespace()
-            self._take_snapshot()
+            self._take_snapshot(now)
             logging.info('Filesystem before backup:')
             self._print_fs_stat(stat_before)
             logging.info('Filesystem after backup:')
@@ -142,13 +150,18 @@ class PyTimeMachine:
 
     def _flock_exclusive(self):
         """lock so only one snapshot of current config is running"""
-        m = hashlib.md5()
-        m.update(self.destination.encode('utf-8'))
-        self._lock_fname = '/tmp/time-machine-%s.lock' % m.hexdigest()
-        self._fl = os.open(self._lock_fname, os.O_CREAT | os.O_TRUNC |
-                           os.O_WRONLY, 0o0600)
+        import hashlib
+
+        digest = hashlib.blake2b(self.destination.encode('utf-8'),
+                                 digest_size=16).hexdigest()
+        self._lock_fname = '/tmp/time-machine-%s.lock' % digest
+        # The lockfile is never removed - unlinking it on release would let
+        # another process lock a fresh inode under the same path while we
+        # still hold the old one.
+        self._fl = os.open(self._lock_fname, os.O_CREAT | os.O_RDWR |
+                           os.O_CLOEXEC, 0o0600)
         try:
-            fcntl.lockf(self._fl, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(self._fl, fcntl.LOCK_EX | fcntl.LOCK_NB)
         except IOError:
             logging.error('Error: cannot obtain lock, there maybe another '
                           'time-machine is running')
@@ -156,41 +169,50 @@ class PyTimeMachine:
             sys.exit(2)
 
     def _flock_release(self):
-        fcntl.lockf(self._fl, fcntl.LOCK_UN)
+        # closing the descriptor drops the flock
         os.close(self._fl)
-        os.remove(self._lock_fname)
 
     def _create_dest_directory(self):
         if self.is_dst_remote:
-            if _run(self._dst_cmd[:] + ['ls', self._dst_path]).returncode != 0:
-                _run(self._dst_cmd[:] + ['mkdir', '-p', self._dst_path])
+            path = self._quoted_dst_path
+            self._remote('ls %s >/dev/null 2>&1 || mkdir -p %s' % (path,
+                                                                   path))
         else:
             if not os.path.exists(self.destination):
                 os.makedirs(self.destination)
 
-    @property
+    @functools.cached_property
     def is_dst_remote(self):
-        if self._is_dst_remote is None:
-            match = REMOTE_PAT.match(self.destination)
-            if match:
-                match = match.groupdict()
-                if not match['user']:
-                    match['user'] = getpass.getuser()
-                self._dst_cmd = ['ssh', match['user'] + '@' + match['host']]
-                self._dst_rsync_partial = match['user'] + '@' + match['host']
-                self._dst_path = match['path']
-                self._is_dst_remote = True
-            else:
-                self._dst_path = self.destination
-                self._is_dst_remote = False
-        return self._is_dst_remote
+        match = REMOTE_PAT.match(self.destination)
+        if match:
+            import getpass
+
+            match = match.groupdict()
+            if not match['user']:
+                match['user'] = getpass.getuser()
+            self._dst_cmd = ['ssh',
+                             '-o', 'ControlMaster=auto',
+                             '-o', 'ControlPath=/tmp/time-machine-ssh-'
+                             '%r@%h:%p',
+                             '-o', 'ControlPersist=60s',
+                             match['user'] + '@' + match['host']]
+            self._dst_rsync_partial = match['user'] + '@' + match['host']
+            self._dst_path = match['path']
+            self._quoted_dst_path = shlex.quote(self._dst_path)
+            return True
+
+        self._dst_path = self.destination
+        return False
+
+    def _remote(self, *argv):
+        """Run a command on the remote destination host."""
+        return _run(self._dst_cmd + list(argv))
 
     def _get_stat(self):
         if self.is_dst_remote:
-            res = _run(self._dst_cmd[:] + ['stat', '-f', self._dst_path])
-            stat = PAT_STAT.match(res.stdout).groupdict()
-            for key in stat:
-                stat[key] = int(stat[key])
+            res = self._remote('stat', '-f', STAT_FORMAT, self._dst_path)
+            stat = dict(zip(STAT_FIELDS,
+                            map(int, res.stdout.strip().split(':'))))
         else:
             stat = os.statvfs(self.destination)
             stat = {'ffree': stat.f_favail,
@@ -201,30 +223,58 @@ class PyTimeMachine:
         return stat
 
     def _find_snapshots(self):
+        snapshots = []
         if self.is_dst_remote:
-            res = _run(self._dst_cmd[:] + ['ls', '-1', '--color=none',
-                                           self._dst_path]).stdout.split('\n')
+            res = self._remote('ls', '-1', '--color=none',
+                               self._dst_path).stdout.split('\n')
+            prefix = self._dst_path.rstrip('/') + '/'
+            for entry in res:
+                match = SNAPSHOT_PAT.match(entry)
+                if match:
+                    dt = datetime.datetime(*map(int, match.groups()))
+                    snapshots.append((dt, prefix + entry))
         else:
-            res = os.listdir(self.destination)
-
-        snapshots = []
-        for entry in res:
-            try:
-                dt = datetime.datetime.strptime(entry, "%Y-%m-%d_%H:%M:%S_GMT")
-                snapshots.append((dt, os.path.join(self._dst_path, entry)))
-            except ValueError:
-                pass
+            with os.scandir(self.destination) as entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    match = SNAPSHOT_PAT.match(entry.name)
+                    if match:
+                        dt = datetime.datetime(*map(int, match.groups()))
+                        snapshots.append((dt, entry.path))
 
         snapshots.sort()
         return snapshots
 
-    def _take_snapshot(self):
+    @staticmethod
+    def _atomic_symlink(target, linkpath):
+        """Point linkpath at target without a window where it is missing."""
+        tmp = linkpath + '.new'
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        os.symlink(target, tmp)
+        os.rename(tmp, linkpath)
+
+    def _rsync_args(self):
+        args = list(RSYNC_ARGS)
+        if sys.stdout.isatty():
+            # per-file progress is only useful on an interactive terminal
+            args.append('--progress')
+        else:
+            # on cron/log runs ask rsync for a transfer summary instead of
+            # megabytes of progress escape sequences
+            args.extend(['-q', '--info=stats2'])
+        return args
+
+    def _take_snapshot(self, now):
         snapshots = self._find_snapshots()
+        remote = self.is_dst_remote
 
-        now = datetime.datetime.utcnow()
         backup_dst = os.path.join(self._dst_path,
                                   now.strftime("%Y-%m-%d_%H:%M:%S_GMT"))
-        args = [x for x in RSYNC_ARGS]
+        args = self._rsync_args()
 
         if self.rsh_command:
             args.extend(['-e', self.rsh_command])
@@ -236,21 +286,13 @@ class PyTimeMachine:
         latest_stat = self._get_file_stat(latest)
         if len(snapshots) > 0 and latest_stat['exists']:
             last_snapshot = latest_stat['target']
-            logging.info('Copying last snapshot.')
-            if self.is_dst_remote:
-                res = _run(self._dst_cmd[:] + ['cp', '-arl', last_snapshot,
-                                               backup_dst])
-            else:
-                res = _run(['cp', '-arl', last_snapshot, backup_dst])
-
-            if res.returncode != 0:
-                logging.error('Unable to clone last snapshot, abort.')
-                exit(2)
+            logging.info('Hardlinking unchanged files from last snapshot.')
+            args.append('--link-dest=%s' % last_snapshot)
 
         elif len(snapshots) > 0 and not latest_stat['exists']:
             if latest_stat['islink']:
-                if self.is_dst_remote:
-                    _run(self._dst_cmd[:] + ['rm', latest])
+                if remote:
+                    self._remote('rm', latest)
                 else:
                     os.remove(latest)
                 logging.error('Error, the "latest" symbol link is broken and '
@@ -259,85 +301,76 @@ class PyTimeMachine:
                 logging.error('Error, cannot find the last snapshot, maybe '
                               'the "latest" symbol link has been deleted. We '
                               'will recreate it empty for next backup...')
-            if self.is_dst_remote:
-                _run(self._dst_cmd[:] + ['mkdir', '-p', backup_dst])
-                _run(self._dst_cmd[:] + ['ln', '-s', backup_dst, latest])
+            if remote:
+                self._remote('mkdir', '-p', backup_dst)
+                self._remote('ln', '-s', backup_dst, latest)
             else:
                 os.mkdir(backup_dst)
                 os.symlink(backup_dst, latest)
             exit(2)
 
         else:  # len(snapshots) == 0
-            if self.is_dst_remote:
-                _run(self._dst_cmd[:] + ['rm', latest])
+            if remote:
+                self._remote('rm', latest)
             elif os.path.lexists(latest):
                 os.remove(latest)
 
-        if self.is_dst_remote:
-            _run(self._dst_cmd[:] + ['mkdir', '-p', backup_dst])
-        elif not os.path.exists(backup_dst):
-            os.mkdir(backup_dst)
-
         args.extend(self.sources)
-        if self.is_dst_remote:
+        if remote:
             args.append(self._dst_rsync_partial + ':' + backup_dst)
         else:
             args.append(backup_dst)
 
         self._run_rsync(args)
 
-        if self.is_dst_remote:
-            _run(self._dst_cmd[:] + ['rm', latest])
-            _run(self._dst_cmd[:] + ['ln', '-s', backup_dst, latest])
-        elif os.path.exists(latest):
-            os.remove(latest)
-            os.symlink(backup_dst, latest)
+        if remote:
+            tmp = shlex.quote(latest + '.new')
+            self._remote('ln -sfn %s %s && mv -T %s %s'
+                         % (shlex.quote(backup_dst), tmp, tmp,
+                            shlex.quote(latest)))
+        else:
+            self._atomic_symlink(backup_dst, latest)
 
-        self._smart_remove(snapshots)
+        self._smart_remove(snapshots, now)
 
     # function from Back In Time
-    def _keep_all(self, snapshots, min_date, max_date):
+    def _keep_all(self, snapshots, dates, min_date, max_date):
         """
         Add all snapshots between min_date and max_date to keep_snapshots
 
         Args:
-            snapshots (list):  [(dt1, snapshot_path1), ...]
+            snapshots (list):  [(dt1, snapshot_path1), ...], sorted by date
+            dates (list):      [dt1, dt2, ...], the sorted snapshot dates
             min_date (datetime.datetime):   minimum date for snapshots to keep
             max_date (datetime.datetime):   maximum date for snapshots to keep
 
         Returns:
             list: list of snapshots that should be kept
         """
-        res = []
-        for (dt, spath) in snapshots:
-            if min_date <= dt and dt <= max_date:
-                res.append(spath)
-        return res
+        lo = bisect.bisect_left(dates, min_date)
+        hi = bisect.bisect_right(dates, max_date)
+        return [spath for _, spath in snapshots[lo:hi]]
 
     # function from Back In Time
-    def _keep_last(self, snapshots, min_date, max_date):
+    def _keep_last(self, snapshots, dates, min_date, max_date):
         """
         Add only the lastest snapshots between min_date and max_date to
         keep_snapshots.
 
         Args:
-            snapshots (list):  [(dt1, snapshot_path1), ...]
+            snapshots (list):  [(dt1, snapshot_path1), ...], sorted by date
+            dates (list):      [dt1, dt2, ...], the sorted snapshot dates
             min_date (datetime.datetime):   minimum date for snapshots to keep
             max_date (datetime.datetime):   maximum date for snapshots to keep
 
         Returns:
             string: the snapshot to be kept
         """
-        res = []
-        for (dt, spath) in snapshots:
-            if min_date <= dt and dt < max_date:
-                res.append((dt, spath))
-
-        if res:
-            res.sort()
-            return [res[-1][1]]
-        else:
-            return []
+        lo = bisect.bisect_left(dates, min_date)
+        hi = bisect.bisect_left(dates, max_date)
+        if hi > lo:
+            return [snapshots[hi - 1][1]]
+        return []
 
     # function from Back In Time
     def inc_month(self, dt):
@@ -351,12 +384,9 @@ class PyTimeMachine:
         Returns:
             datetime.date:          1st day of next month
         """
-        y = dt.year
-        m = dt.month + 1
-        if m > 12:
-            m = 1
-            y = y + 1
-        return datetime.datetime(y, m, 1)
+        # day 32 always lands in the next month
+        return (dt.replace(day=1) +
+                datetime.timedelta(days=32)).replace(day=1)
 
     # function from Back In Time
     def dec_month(self, dt):
@@ -371,15 +401,47 @@ class PyTimeMachine:
         Returns:
             datetime.date:          1st day of previous month
         """
-        y = dt.year
-        m = dt.month - 1
-        if m < 1:
-            m = 12
-            y = y - 1
-        return datetime.datetime(y, m, 1)
+        return (dt.replace(day=1) - ONEDAY).replace(day=1)
+
+    def _buckets(self, now, first_year):
+        """
+        Yield (min_date, max_date) ranges whose latest snapshot should be
+        kept, covering the configured daily, weekly and monthly intervals
+        plus one bucket per year of existing snapshots.
+
+        Args:
+            now (datetime.datetime):    timestamp of the current backup
+            first_year (int):           year of the oldest snapshot
+        """
+        # utc 00:00:00
+        today = datetime.datetime(now.year, now.month, now.day, 0, 0, 0)
+
+        # one per day for the last keep_one_per_day days
+        for _ in range(self.smart_remove['keep_one_per_day']):
+            yield today, today + ONEDAY
+            today -= ONEDAY
+
+        # one per week for the last keep_one_per_week weeks
+        d = today - datetime.timedelta(days=today.weekday() + 1)
+        for _ in range(self.smart_remove['keep_one_per_week']):
+            yield d, d + datetime.timedelta(days=8)
+            d -= datetime.timedelta(days=7)
+
+        # one per month for the last keep_one_per_month months
+        d1 = datetime.datetime(now.year, now.month, 1)
+        d2 = self.inc_month(d1)
+        for _ in range(self.smart_remove['keep_one_per_month']):
+            yield d1, d2
+            d2 = d1
+            d1 = self.dec_month(d1)
+
+        # one per year for all years
+        for year in range(first_year, now.year + 1):
+            yield (datetime.datetime(year, 1, 1),
+                   datetime.datetime(year + 1, 1, 1))
 
     # function from Back In Time
-    def _smart_remove(self, snapshots):
+    def _smart_remove(self, snapshots, now):
         """
         Remove old snapshots based on configurable intervals.
 
@@ -397,67 +459,25 @@ class PyTimeMachine:
             logging.info("There is only one snapshots, so keep it")
             return
 
-        now = datetime.datetime.utcnow()
         keep_all = self.smart_remove['keep_all']
-        keep_one_per_day = self.smart_remove['keep_one_per_day']
-        keep_one_per_week = self.smart_remove['keep_one_per_week']
-        keep_one_per_month = self.smart_remove['keep_one_per_month']
-
-        # utc 00:00:00
-        today = datetime.datetime(now.year, now.month, now.day, 0, 0, 0)
         snapshots.sort()
+        dates = [dt for dt, _ in snapshots]
 
         # keep the last snapshot
-        keep_snapshots = [snapshots[-1][1]]
+        keep_snapshots = {snapshots[-1][1]}
 
         # keep all for the last keep_all days x 24 hours
         if keep_all > 0:
-            tmp = self._keep_all(snapshots,
+            tmp = self._keep_all(snapshots, dates,
                                  now - datetime.timedelta(days=keep_all), now)
-            keep_snapshots.extend(tmp)
-
-        # keep one per days for the last keep_one_per_day days
-        if keep_one_per_day > 0:
-            for _ in range(0, keep_one_per_day):
-                tmp = self._keep_last(snapshots, today, today + ONEDAY)
-                keep_snapshots.extend(tmp)
-                today -= ONEDAY
-
-        # keep one per week for the last keep_one_per_week weeks
-        if keep_one_per_week > 0:
-            d = today - datetime.timedelta(days=today.weekday() + 1)
-            for _ in range(0, keep_one_per_week):
-                tmp = self._keep_last(snapshots, d,
-                                      d + datetime.timedelta(days=8))
-                keep_snapshots.extend(tmp)
-                d -= datetime.timedelta(days=7)
-
-        # keep one per month for the last keep_one_per_month months
-        if keep_one_per_month > 0:
-            d1 = datetime.datetime(now.year, now.month, 1)
-            d2 = self.inc_month(d1)
-            for i in range(0, keep_one_per_month):
-                tmp = self._keep_last(snapshots, d1, d2)
-                keep_snapshots.extend(tmp)
-                d2 = d1
-                d1 = self.dec_month(d1)
-
-        # keep one per year for all years
-        first_year = snapshots[0][0].year
-
-        for i in range(first_year, now.year + 1):
-            tmp = self._keep_last(snapshots, datetime.datetime(i, 1, 1),
-                                  datetime.datetime(i + 1, 1, 1))
-            keep_snapshots.extend(tmp)
-
-        tmp = set(keep_snapshots)
-        keep_snapshots = tmp
-        del_snapshots = []
-        for dt, s in snapshots:
-            if s in keep_snapshots:
-                continue
+            keep_snapshots.update(tmp)
+
+        # keep the latest snapshot of every daily/weekly/monthly/yearly bucket
+        for d1, d2 in self._buckets(now, snapshots[0][0].year):
+            keep_snapshots.update(self._keep_last(snapshots, dates, d1, d2))
 
-            del_snapshots.append(s)
+        del_snapshots = [s for _, s in snapshots
+                         if s not in keep_snapshots]
 
         if not del_snapshots:
             logging.info('No snapshot to remove')
@@ -466,17 +486,19 @@ class PyTimeMachine:
         for snapshot in del_snapshots:
             logging.info('Delete snapshot %s', snapshot)
 
-            if self.is_dst_remote:
-                _run(self._dst_cmd[:] + ['rm', '-fr', snapshot])
-            else:
-                shutil.rmtree(snapshot)
+        if self.is_dst_remote:
+            self._remote('rm', '-fr', *del_snapshots)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=os.cpu_count()) as executor:
+                list(executor.map(shutil.rmtree, del_snapshots))
 
     def _run_rsync(self, args):
         cmd = ['rsync']
         cmd.extend(args)
         logging.info('running cmd: %s', ' '.join(cmd))
         try:
-            res = _run(cmd)
+            res = _run_streaming(cmd)
             if res.returncode == 0:
                 logging.info('Rsynced successfully')
             else:
@@ -490,18 +512,23 @@ class PyTimeMachine:
                   'target': None}
 
         if self.is_dst_remote:
-            res = _run(self._dst_cmd[:] + ['readlink', latest])
-            if res.returncode == 0:
-                result['target'] = res.stdout.strip()
-            if _run(self._dst_cmd[:] +
-                    [f'[ -e "{latest}" ]']).returncode != 0:
-                result['broken'] = True
-            else:
+            path = shlex.quote(latest)
+            # readlink only runs when the path really is a symlink, so a
+            # first-ever backup does no more remote work than the two tests
+            res = self._remote('[ -e %s ] && echo E; '
+                               'if [ -L %s ]; then echo L; readlink %s; fi; '
+                               'true' % (path, path, path))
+            lines = res.stdout.splitlines()
+            if lines and lines[0] == 'E':
                 result['exists'] = True
-            if _run(self._dst_cmd[:] +
-                    [f'[ -L "{latest}" ]']).returncode == 0:
+                lines = lines[1:]
+            else:
+                result['broken'] = True
+            if lines and lines[0] == 'L':
                 result['exists'] = True
                 result['islink'] = True
+                if len(lines) > 1:
+                    result['target'] = lines[1]
             return result
 
         if os.path.islink(latest):
@@ -543,60 +570,36 @@ class PyTimeMachine:
 
     def _print_fs_stat(self, stat):
 
-        def humanize_bytes(n):
+        def humanize(n, units):
             n = int(n)
-            if n >= ONET:
-                ret = '%.2f TB' % (n / ONET)
-            elif n >= ONEG:
-                ret = '%.2f GB' % (n / ONEG)
-            elif n >= ONEM:
-                ret = '%.0f MB' % (n / ONEM)
-            elif n >= ONEK:
-                ret = '%.0f KB' % (n / ONEK)
-            else:
-                ret = '%d Bytes' % n
-
-            return ret
-
-        def humanize_inodes(n):
-            n = int(n)
-            if n >= ONET:
-                ret = '%.0f T' % (n / ONET)
-            elif n >= ONEG:
-                ret = '%.0f G' % (n / ONEG)
-            elif n >= ONEM:
-                ret = '%.0f M' % (n / ONEM)
-            elif n >= ONEK:
-                ret = '%.0f K' % (n / ONEK)
-            else:
-                ret = '%d ' % n
-
-            return ret
+            index = min(max(n.bit_length() - 1, 0) // 10, len(units) - 1)
+            div, suffix, fmt = units[index]
+            return (fmt % (n / div)) + ' ' + suffix
 
         space_free = stat['bavail'] * stat['bsize']
         space_total = stat['blocks'] * stat['bsize']
         space_used = (space_total - space_free) * 100.0 / space_total
         logging.info('    free space: %s, %.1f%% used',
-                     humanize_bytes(space_free), space_used)
+                     humanize(space_free, BYTE_UNITS), space_used)
         if self._check_inodes:
             inodes_free = stat['ffree']
             inodes_used = (stat['files'] -
                            stat['ffree']) * 100.0 / stat['files']
             logging.info('    free inodes: %s, %.1f%% used',
-                         humanize_inodes(inodes_free), inodes_used)
+                         humanize(inodes_free, INODE_UNITS), inodes_used)
 
     def _read_config(self):
+        import yaml
+        import yaml.error
+
         conf_files = CONF_FILES[:]
         if self._configfile:
             conf_files = [self._configfile]
-            try:
-                with open(self._configfile) as fobj:
-                    fobj.read()
-            except OSError as ex:
-                pass
-                logging.error('Cannot access file %s: %s', self._configfile,
-                              ex.strerror)
-                sys.exit(1)
+
+        if yaml.__with_libyaml__:
+            loader = yaml.CSafeLoader
+        else:
+            loader = yaml.SafeLoader
 
         conf_dict = None
         for fname in conf_files:
@@ -606,10 +609,9 @@ class PyTimeMachine:
 
             try:
                 with open(fname) as fobj:
-                    conf_dict = yaml.safe_load(fobj)
+                    conf_dict = yaml.load(fobj, Loader=loader)
             except OSError as ex:
-                logging.error('Cannot access file %s: %s', self._configfile,
-                              ex.strerror)
+                logging.error('Cannot access file %s: %s', fname, ex.strerror)
                 sys.exit(1)
 
             except yaml.error.YAMLError as ex:
@@ -661,9 +663,21 @@ class PyTimeMachine:
 
 
 def _run(command):
+    """Run a short command and capture its output for parsing."""
     return subprocess.run(command, capture_output=True, encoding='utf-8')
 
 
+def _run_streaming(command):
+    """Run a command inheriting stdout/stderr.
+
+    Used for rsync, whose --progress/--itemize-changes output can grow
+    to hundreds of megabytes - buffering it in memory would spike RSS
+    for no benefit, and progress is only useful when written straight
+    to the terminal.
+    """
+    return subprocess.run(command)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='alternative config file')